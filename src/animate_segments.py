@@ -1,103 +1,185 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import hydra
 import json
 import logging
+from multiprocessing import shared_memory
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from omegaconf import DictConfig
 from pathlib import Path
+import subprocess
 from tqdm import tqdm
 
 import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
 from matplotlib import patches
-from functools import partial
 
-from utils import load_refaudio, rms_norm
+from utils import AudioCache, load_refaudio, lookup, rms_norm
 
 PLOT_FS = 500
+FRAME_DT = 0.01
+ANIMATION_PEOPLE = {"sumwave": "summed", "targetwave": "target", "targetpower": "power"}
 
 AUDIO_FS = 16000
 
 
-def framewise_rms(snippet):
+def framewise_rms(snippet, chunk_frames=2**16):
     hop = int(AUDIO_FS / PLOT_FS)
     window = 10 * hop
-    ham = np.hamming(window)
-    audio_len = snippet.shape[0]
+    ham_sq = np.square(np.hamming(window))
+    n_frames = len(range(0, snippet.shape[0] - window, hop))
 
-    rms = []
+    # mean((frame * ham)^2) is the frame's squared samples weighted by ham^2,
+    # so each chunk of strided frame views reduces with a single matmul
+    frames = sliding_window_view(snippet, window)[::hop][:n_frames]
+    power = np.empty(n_frames)
+    for i in range(0, n_frames, chunk_frames):
+        power[i : i + chunk_frames] = np.square(frames[i : i + chunk_frames]) @ ham_sq
 
-    for i in range(0, audio_len - window, hop):
-        frame = snippet[i : i + window] * ham
-        rms.append(np.log(np.sqrt(np.mean(np.square(frame))) + 1e-5))
+    rms = np.log(np.sqrt(power / window) + 1e-5)
     rms = np.convolve(rms, np.hamming(100), mode="same")
     return rms
 
 
-def animate_waveform(snippet, target_start, person, fpath):
-
+def draw_waveform(snippet, target_start, person):
+    # Faint and fully drawn frames, and the pixel column reached at each frame
     fig, ax = plt.subplots(figsize=[6, 2])
-    (line1,) = ax.plot([], [], "tab:blue")
 
-    dt = 0.01
     signal_seconds = snippet.shape[0] / PLOT_FS
     t = np.linspace(0, signal_seconds, len(snippet))
 
-    def init():
-        ymin, ymax = min(snippet), max(snippet)
-        ymax = ymax + (ymax - ymin) * 0.2
-        text_top = ymax * 0.95 + ymin * 0.05
-
-        ax.set_ylim(ymin, ymax)
-        ax.set_xlim(0, signal_seconds)
-        ax.axis("off")
-
-        rect = patches.Rectangle(
-            (target_start, ymin),
-            signal_seconds - target_start,
-            ymax - ymin,
-            color="gray",
-            alpha=0.15,
-        )
-        ax.add_patch(rect)
-        ax.axvline(target_start, color="r")
-
-        ax.plot(t, snippet, "tab:blue", alpha=0.2)
-
-        mid = (target_start + signal_seconds) / 2
-
-        ax.text(mid, text_top, "Transcribe here", ha="center", va="top")
-        if person == "target":
-            ax.text(0, ymax, "Target audio", va="top", ha="left")
-        else:
-            ax.text(0, ymax, "Summed audio", va="top", ha="left")
-
-        return (line1,)
-
-    def update(frame, ln, x, y):
-        start = int(frame * PLOT_FS)
-        end = int((frame + dt) * PLOT_FS) + 1
-        end = min(end, snippet.shape[-1])
-
-        x += list(t[start:end])
-        y += list(snippet[start:end])
-        ln.set_data(x, y)
-        return (ln,)
-
-    ani = FuncAnimation(
-        fig,
-        partial(update, ln=line1, x=[], y=[]),
-        frames=np.arange(0, signal_seconds, dt),
-        init_func=init,
-        blit=True,
-        interval=dt * 1000,
-        repeat=False,
+    ymin, ymax = np.min(snippet), np.max(snippet)
+    ymax = ymax + (ymax - ymin) * 0.2
+    text_top = ymax * 0.95 + ymin * 0.05
+
+    ax.set_ylim(ymin, ymax)
+    ax.set_xlim(0, signal_seconds)
+    ax.axis("off")
+
+    rect = patches.Rectangle(
+        (target_start, ymin),
+        signal_seconds - target_start,
+        ymax - ymin,
+        color="gray",
+        alpha=0.15,
     )
+    ax.add_patch(rect)
+    ax.axvline(target_start, color="r")
+
+    ax.plot(t, snippet, "tab:blue", alpha=0.2)
+
+    mid = (target_start + signal_seconds) / 2
+
+    ax.text(mid, text_top, "Transcribe here", ha="center", va="top")
+    if person == "target":
+        ax.text(0, ymax, "Target audio", va="top", ha="left")
+    elif person == "power":
+        ax.text(0, ymax, "Target power", va="top", ha="left")
+    else:
+        ax.text(0, ymax, "Summed audio", va="top", ha="left")
+
+    fig.canvas.draw()
+    background = np.asarray(fig.canvas.buffer_rgba())[..., :3].copy()
+
+    ax.plot(t, snippet, "tab:blue")
+    fig.canvas.draw()
+    foreground = np.asarray(fig.canvas.buffer_rgba())[..., :3].copy()
+
+    frame_times = np.arange(0, signal_seconds, FRAME_DT) + FRAME_DT
+    columns = ax.transData.transform(
+        np.stack([frame_times, np.zeros_like(frame_times)], axis=1)
+    )[:, 0]
+    columns = np.clip(np.ceil(columns), 0, background.shape[1]).astype(int)
+
+    plt.close(fig)
+    return background, foreground, columns
+
+
+def animate_waveform(snippet, target_start, person, fpath):
+    background, foreground, columns = draw_waveform(snippet, target_start, person)
+    height, width, _ = background.shape
 
     if not Path(fpath).parent.exists():
         Path(fpath).parent.mkdir(parents=True)
 
-    ani.save(fpath, writer="ffmpeg", fps=1 / dt)
-    plt.close(fig)
+    ffmpeg = subprocess.Popen(
+        [
+            "ffmpeg",
+            "-y",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(round(1 / FRAME_DT)),
+            "-i",
+            "-",
+            "-c:v",
+            "libx264",
+            "-pix_fmt",
+            "yuv420p",
+            str(fpath),
+        ],
+        stdin=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    # Only the newly reached columns change between frames
+    frame = background.copy()
+    drawn = 0
+    try:
+        for column in columns:
+            frame[:, drawn:column] = foreground[:, drawn:column]
+            drawn = max(drawn, column)
+            ffmpeg.stdin.write(frame.tobytes())
+    except BrokenPipeError:
+        # ffmpeg exited early; its stderr is reported below
+        pass
+    finally:
+        try:
+            ffmpeg.stdin.close()
+        except BrokenPipeError:
+            pass
+        ffmpeg.wait()
+
+    if ffmpeg.returncode != 0:
+        raise RuntimeError(
+            f"ffmpeg failed writing {fpath}: {ffmpeg.stderr.read().decode()}"
+        )
+    ffmpeg.stderr.close()
+
+
+def share_array(array):
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, array.dtype, buffer=shm.buf)
+    shared[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+
+
+def render_segment(waveform, start, end, target_start, person, fpath):
+    snippet = waveform[start:end]
+    if person != "power":
+        snippet = rms_norm(snippet, 0.05)
+    animate_waveform(snippet, target_start, person, fpath)
+
+
+def render_shared(spec, start, end, target_start, person, fpath):
+    shm, waveform = attach_array(spec)
+    try:
+        render_segment(waveform, start, end, target_start, person, fpath)
+    finally:
+        del waveform
+        shm.close()
 
 
 @hydra.main(version_base=None, config_path="../config", config_name="main")
@@ -105,75 +187,103 @@ def main(cfg: DictConfig):
     segments_fpath = cfg.filtered_store
     audio_fpath = cfg.ref_session_file
     animation_ftemplate = cfg.animations_file
+    cache = AudioCache(cfg.audio_cache_dir, cfg.audio_cache_max_gb)
+    for anim in cfg.animation_types:
+        lookup(ANIMATION_PEOPLE, anim, "Animation type")
 
     with open(segments_fpath, "r") as file:
         sessions = json.load(file)
 
     logging.disable(logging.INFO)
 
+    pool = ProcessPoolExecutor(cfg.jobs) if cfg.jobs > 1 else None
+
     for sess_info in sessions:
         session = sess_info["session"]
         device = sess_info["device"]
         pid = sess_info["pid"]
-        # pos = f"pos{sess_info['device_pos']}"
-        sum_waveform, fs = load_refaudio(
-            audio_fpath,
-            session,
-            device,
-            [f"pos{i}" for i in range(1, 5)],
-            target_sr=PLOT_FS,
-        )
-        target_waveform, _ = load_refaudio(
-            audio_fpath, session, device, pid, target_sr=PLOT_FS
-        )
 
-        # target_power, _ = load_refaudio(
-        #     audio_fpath, session, device, pid, target_sr=AUDIO_FS
-        # )
-
-        for seg in tqdm(sess_info["segments"], desc=f"{session} {pid}"):
+        tasks = []
+        for seg in sess_info["segments"]:
             start = int(seg["start_time"] * PLOT_FS)
             end = int(seg["end_time"] * PLOT_FS)
             target_start = seg["speech"]["start_time"] - seg["start_time"]
 
-            snippet = rms_norm(sum_waveform[start:end], 0.05)
-            fpath = animation_ftemplate.format(
-                session=session,
-                device=device,
-                pid=pid,
-                seg=seg["index"],
-                anim="sumwave",
+            for anim in cfg.animation_types:
+                fpath = animation_ftemplate.format(
+                    session=session,
+                    device=device,
+                    pid=pid,
+                    seg=seg["index"],
+                    anim=anim,
+                )
+                if not Path(fpath).exists() or cfg.overwrite:
+                    tasks.append((anim, start, end, target_start, fpath))
+
+        if len(tasks) == 0:
+            continue
+
+        needed = {x[0] for x in tasks}
+        waveforms = {}
+        if "sumwave" in needed:
+            waveforms["sumwave"], _ = load_refaudio(
+                audio_fpath,
+                session,
+                device,
+                [f"pos{i}" for i in range(1, 5)],
+                target_sr=PLOT_FS,
+                cache=cache,
             )
-            if not Path(fpath).exists() or cfg.overwrite:
-                animate_waveform(snippet, target_start, "summed", fpath)
-
-            snippet = rms_norm(target_waveform[start:end], 0.05)
-
-            fpath = animation_ftemplate.format(
-                session=session,
-                device=device,
-                pid=pid,
-                seg=seg["index"],
-                anim="targetwave",
+        if "targetwave" in needed:
+            waveforms["targetwave"], _ = load_refaudio(
+                audio_fpath, session, device, pid, target_sr=PLOT_FS, cache=cache
+            )
+        if "targetpower" in needed:
+            # Frame hop is AUDIO_FS / PLOT_FS, so the power is indexed like the
+            # waveforms and only needs computing once per session
+            target_power, _ = load_refaudio(
+                audio_fpath, session, device, pid, target_sr=AUDIO_FS, cache=cache
             )
-            if not Path(fpath).exists() or cfg.overwrite:
-                animate_waveform(snippet, target_start, "target", fpath)
-
-            # start = int(seg["start_time"] * AUDIO_FS)
-            # end = int(seg["end_time"] * AUDIO_FS)
-            # snippet = target_power[start:end]
-            # thing = framewise_rms(snippet)
-
-            # fpath = animation_ftemplate.format(
-            #     session=session,
-            #     device=device,
-            #     pid=pid,
-            #     seg=seg["index"],
-            #     anim="targetpower",
-            # )
-
-            # if not Path(fpath).exists() or cfg.overwrite:
-            #     animate_waveform(thing, target_start, "target", fpath)
+            waveforms["targetpower"] = framewise_rms(target_power)
+
+        desc = f"{session} {pid}"
+        if pool is None:
+            for anim, start, end, target_start, fpath in tqdm(tasks, desc=desc):
+                render_segment(
+                    waveforms[anim],
+                    start,
+                    end,
+                    target_start,
+                    ANIMATION_PEOPLE[anim],
+                    fpath,
+                )
+            continue
+
+        # Workers map the session waveforms from shared memory instead of
+        # receiving a pickled copy with every segment
+        shared = {anim: share_array(np.asarray(x)) for anim, x in waveforms.items()}
+        try:
+            futures = [
+                pool.submit(
+                    render_shared,
+                    shared[anim][1],
+                    start,
+                    end,
+                    target_start,
+                    ANIMATION_PEOPLE[anim],
+                    fpath,
+                )
+                for anim, start, end, target_start, fpath in tasks
+            ]
+            for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+                future.result()
+        finally:
+            for shm, _ in shared.values():
+                shm.close()
+                shm.unlink()
+
+    if pool is not None:
+        pool.shutdown()
 
 
 if __name__ == "__main__":
@@ -1,18 +1,22 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import csv
 import hydra
 import json
 import numpy as np
 from omegaconf import DictConfig
-import os
 from pathlib import Path
 import soundfile as sf
+import time
+from tqdm import tqdm
 
-from utils import load_audio, rms_norm, load_refaudio
+from mux import run_mux_jobs
+from utils import AudioCache, load_refaudio, open_session, rms_norm
 
 TARGET_SR = 16000
+DEVICE_CHANNELS = {"aria": 2, "ha": [0, 1]}
 
 
-def get_ref(ftemplate, sess_info, device):
+def get_ref(ftemplate, sess_info, device, cache=None):
 
     devpos = int(sess_info[f"{device}_pos"])
     others = [f"pos{i}" for i in range(1, 5) if i != devpos]
@@ -20,106 +24,161 @@ def get_ref(ftemplate, sess_info, device):
     assert len(others) == 3
 
     audio, fs = load_refaudio(
-        ftemplate, sess_info["session"], device, others, normalize=0.05
+        ftemplate,
+        sess_info["session"],
+        device,
+        others,
+        normalize=0.05,
+        cache=cache,
     )
 
     return audio
 
 
-@hydra.main(version_base=None, config_path="../config", config_name="main")
-def main(cfg: DictConfig):
-    segments_fpath = cfg.filtered_store
-    animation_ftemplate = cfg.animations_file
-    experiment = cfg.experiment
-    sessions_file = cfg.sessions_file.format(dataset="dev")
+def to_mono(audio):
+    # Channels are already selected when the session is opened
+    if audio.ndim == 2:
+        audio = np.sum(audio, axis=1)
+    return audio
 
-    with open(sessions_file, "r") as file:
-        sess_csv = {a["session"]: a for a in csv.DictReader(file)}
 
+def get_session_ftemplate(cfg: DictConfig, experiment: str):
     if experiment == "passthrough" or experiment == "noisy":
-        session_ftemplate = cfg.noisy_session_file
+        return cfg.noisy_session_file
     elif experiment == "ref":
-        session_ftemplate = cfg.ref_session_file
+        return cfg.ref_session_file
     elif experiment == "ct":
-        session_ftemplate = cfg.ct_session_file
-    else:
-        session_ftemplate = cfg.exp_session_file
+        return cfg.ct_session_file
+    return cfg.exp_session_file
+
+
+def process_session(cfg: DictConfig, sess_info, sess_row):
+    tic = time.perf_counter()
 
+    animation_ftemplate = cfg.animations_file
+    experiment = cfg.experiment
+    cache = AudioCache(cfg.audio_cache_dir, cfg.audio_cache_max_gb)
+
+    session_ftemplate = get_session_ftemplate(cfg, experiment)
     output_audio_ftemplate = cfg.exp_segment_audio
     output_video_ftemplate = cfg.exp_segment_video
 
-    with open(segments_fpath, "r") as file:
-        sessions = json.load(file)
-
-    for sess_info in sessions:
-        session = sess_info["session"]
-        device = sess_info["device"]
-        pid = sess_info["pid"]
+    session = sess_info["session"]
+    device = sess_info["device"]
+    pid = sess_info["pid"]
 
-        if experiment in ["ref", "ct"]:
-            session_audio = get_ref(session_ftemplate, sess_csv[session], device)
-        else:
-            infpath = session_ftemplate.format(
-                dataset="dev", exp=experiment, session=session, device=device, pid=pid
+    if experiment in ["ref", "ct"]:
+        session_audio = get_ref(session_ftemplate, sess_row, device, cache)
+    else:
+        infpath = session_ftemplate.format(
+            dataset="dev", exp=experiment, session=session, device=device, pid=pid
+        )
+        # Memory-mapped, so each segment only touches the frames it needs
+        session_audio = open_session(infpath, DEVICE_CHANNELS[device], TARGET_SR)
+
+    mux_jobs = []
+    for segment in sess_info["segments"]:
+
+        seg_audio_fpath = Path(
+            output_audio_ftemplate.format(
+                dataset="dev",
+                exp=experiment,
+                session=session,
+                device=device,
+                pid=pid,
+                seg=segment["index"],
             )
-            session_audio, _ = load_audio(infpath, TARGET_SR, 0.05)
+        )
+
+        start = int(segment["start_time"] * TARGET_SR)
+        end = int(segment["end_time"] * TARGET_SR)
+
+        snippet = to_mono(session_audio[start:end])
+        snippet = rms_norm(snippet, 0.05)
 
-        if session_audio.ndim == 2:
-            if device == "aria":
-                session_audio = session_audio[:, 2]
-            else:
-                session_audio = np.sum(session_audio[:, :2], axis=1)
+        if not seg_audio_fpath.parent.exists():
+            seg_audio_fpath.parent.mkdir(parents=True, exist_ok=True)
 
-        for segment in sess_info["segments"]:
+        sf.write(seg_audio_fpath, snippet, TARGET_SR)
 
-            seg_audio_fpath = Path(
-                output_audio_ftemplate.format(
+        for anim in cfg.animation_types:
+            seg_video_fpath = Path(
+                output_video_ftemplate.format(
+                    dataset="dev",
+                    exp=experiment,
+                    session=session,
+                    device=device,
+                    pid=pid,
+                    seg=segment["index"],
+                    anim=anim,
+                )
+            )
+            anim_fpath = Path(
+                animation_ftemplate.format(
                     dataset="dev",
                     exp=experiment,
                     session=session,
                     device=device,
                     pid=pid,
                     seg=segment["index"],
+                    anim=anim,
                 )
             )
+            mux_jobs.append((anim_fpath, seg_audio_fpath, seg_video_fpath))
 
-            start = int(segment["start_time"] * TARGET_SR)
-            end = int(segment["end_time"] * TARGET_SR)
+    return {
+        "name": f"{session}.{device}.{pid}",
+        "segments": len(sess_info["segments"]),
+        "mux_jobs": mux_jobs,
+        "seconds": time.perf_counter() - tic,
+    }
 
-            snippet = rms_norm(session_audio[start:end], 0.05)
 
-            if not seg_audio_fpath.parent.exists():
-                seg_audio_fpath.parent.mkdir(parents=True)
+def print_summary(summaries, n_muxed, n_skipped, failures):
+    fstring = "{:<30}{:<10}{:<10}"
+    print(fstring.format("session", "segments", "seconds"))
+    for x in summaries:
+        print(fstring.format(x["name"], x["segments"], f"{x['seconds']:.1f}"))
 
-            sf.write(seg_audio_fpath, snippet, TARGET_SR)
+    print(f"\nVideos muxed: {n_muxed}, unchanged: {n_skipped}, failed: {len(failures)}")
+    for fpath, error in failures:
+        print(f"ffmpeg failed: {fpath}\n{error}")
 
-            for anim in cfg.animation_types:
-                seg_video_fpath = Path(
-                    output_video_ftemplate.format(
-                        dataset="dev",
-                        exp=experiment,
-                        session=session,
-                        device=device,
-                        pid=pid,
-                        seg=segment["index"],
-                        anim=anim,
-                    )
-                )
-                anim_fpath = Path(
-                    animation_ftemplate.format(
-                        dataset="dev",
-                        exp=experiment,
-                        session=session,
-                        device=device,
-                        pid=pid,
-                        seg=segment["index"],
-                        anim=anim,
-                    )
-                )
-                if not seg_video_fpath.exists() or cfg.overwrite:
-                    os.system(
-                        f"ffmpeg -y -hide_banner -loglevel error -i {anim_fpath} -i {seg_audio_fpath} -c:v copy -c:a aac {seg_video_fpath}"
-                    )
+
+@hydra.main(version_base=None, config_path="../config", config_name="main")
+def main(cfg: DictConfig):
+    segments_fpath = cfg.filtered_store
+    sessions_file = cfg.sessions_file.format(dataset="dev")
+
+    with open(sessions_file, "r") as file:
+        sess_csv = {a["session"]: a for a in csv.DictReader(file)}
+
+    with open(segments_fpath, "r") as file:
+        sessions = json.load(file)
+
+    if cfg.jobs > 1:
+        # Each session writes its own files, so they can run in any order;
+        # summaries are still collected in the order of the segments file
+        with ProcessPoolExecutor(cfg.jobs) as pool:
+            futures = [
+                pool.submit(process_session, cfg, x, sess_csv[x["session"]])
+                for x in sessions
+            ]
+            for _ in tqdm(as_completed(futures), total=len(futures)):
+                pass
+            summaries = [f.result() for f in futures]
+    else:
+        summaries = [
+            process_session(cfg, x, sess_csv[x["session"]]) for x in tqdm(sessions)
+        ]
+
+    # Mux every session's videos together so ffmpeg calls can be batched
+    jobs = [job for x in summaries for job in x["mux_jobs"]]
+    n_muxed, n_skipped, failures = run_mux_jobs(
+        jobs, cfg.mux_jobs, cfg.mux_batch, cfg.overwrite
+    )
+
+    print_summary(summaries, n_muxed, n_skipped, failures)
 
 
 if __name__ == "__main__":
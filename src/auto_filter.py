@@ -1,4 +1,7 @@
+from concurrent.futures import ProcessPoolExecutor
+import csv
 import hydra
+import itertools
 import json
 import numpy as np
 from omegaconf import DictConfig
@@ -6,22 +9,48 @@ from pathlib import Path
 
 from utils import load_csv, load_json, get_wearer_targets
 
-GRANULARITY = 10
 
+class OverlapIndex:
+    # Speech intervals per speaker, sorted by start with a running max end
+
+    def __init__(self, transcripts):
+        self.intervals = {}
+        for pid, transcript in transcripts.items():
+            starts = np.array([x["start_time"] for x in transcript], dtype=float)
+            ends = np.array([x["end_time"] for x in transcript], dtype=float)
+            index = np.flatnonzero(ends > starts)
+            index = index[np.argsort(starts[index], kind="stable")]
+            self.intervals[pid] = (
+                starts[index],
+                ends[index],
+                np.maximum.accumulate(ends[index]),
+                index,
+            )
 
-def get_vad_array(transcripts):
-    max_len = max(max(x["end_time"] for x in y) for y in transcripts.values())
-    max_sample = int(GRANULARITY * max_len)
-
-    vad = {}
-    for pid, transcript in transcripts.items():
-        vad[pid] = np.zeros(max_sample) - 1
-
-        for i, seg in enumerate(transcript):
-            start = int(seg["start_time"] * GRANULARITY)
-            end = int(seg["end_time"] * GRANULARITY)
-            vad[pid][start:end] = i
-    return vad
+    def any_active(self, pids, starts, ends):
+        # Whether any of pids is speaking in each [start, end) window
+        active = np.zeros(len(starts), dtype=bool)
+        for pid in pids:
+            seg_starts, _, max_ends, _ = self.intervals[pid]
+            if len(seg_starts) == 0:
+                continue
+            # Last interval starting before the window ends
+            last = np.searchsorted(seg_starts, ends, side="left") - 1
+            active |= (last >= 0) & (max_ends[np.maximum(last, 0)] > starts)
+        return active
+
+    def segments(self, pid, starts, ends):
+        # Sorted indices of the segments of pid overlapping each window
+        seg_starts, seg_ends, max_ends, index = self.intervals[pid]
+        # Only intervals between the first whose running max end passes the
+        # window start and the last starting before its end can overlap
+        first = np.searchsorted(max_ends, starts, side="right")
+        last = np.searchsorted(seg_starts, ends, side="left")
+        overlaps = []
+        for start, i, j in zip(starts, first, last):
+            found = index[i:j][seg_ends[i:j] > start]
+            overlaps.append(np.sort(found))
+        return overlaps
 
 
 def extract_hits(transcripts, hits, target):
@@ -70,10 +99,12 @@ def count_words(text: str):
     return count, clean
 
 
-def filter_n_words(transcript, min_words, max_words):
+def filter_n_words(transcript, min_words, max_words, counts=None):
+    if counts is None:
+        counts = [count_words(seg["text"]) for seg in transcript]
+
     suitable = []
-    for seg in transcript:
-        n_words, clean = count_words(seg["text"])
+    for seg, (n_words, clean) in zip(transcript, counts):
         if n_words >= min_words and n_words <= max_words:
             seg["clean"] = clean
             suitable.append(seg)
@@ -86,93 +117,177 @@ def filter_prewindow(targ_ts, target, vad, partner, wearers, prewindow):
     if isinstance(wearers, str):
         wearers = [wearers]
 
-    wearer_vad = np.concatenate([vad[w] for w in wearers])
+    index = np.array([seg["index"] for seg in targ_ts], dtype=int)
+    targ_starts = np.array([seg["start_time"] for seg in targ_ts], dtype=float)
+    pre_starts = targ_starts - prewindow
+    ends = np.array([seg["end_time"] for seg in targ_ts], dtype=float)
 
-    hits = []
+    # Ignore segments where any device wearer is talking
+    quiet = ~vad.any_active(wearers, pre_starts, ends)
 
-    for seg in targ_ts:
-        index = seg["index"]
-        targ_start = int(seg["start_time"] * GRANULARITY)
-        pre_start = int(targ_start - prewindow * GRANULARITY)
-        end = int(seg["end_time"] * GRANULARITY)
+    priors = {
+        pid: vad.segments(pid, pre_starts, targ_starts) for pid in [target, partner]
+    }
 
-        if any(wearer_vad[pre_start:end] >= 0):
-            # Ignore if device wearer is talking
-            continue
-
-        priors = {}
-        for pid in [target, partner]:
-            segments = list(set(vad[pid][pre_start:targ_start]))
-            segments = [int(s) for s in segments if s >= 0]
-            if len(segments) > 0:
-                priors[pid] = segments
-
-        if len(priors) == 0:
+    hits = []
+    for i in np.flatnonzero(quiet):
+        seg_priors = {
+            pid: [int(s) for s in segments[i]]
+            for pid, segments in priors.items()
+            if len(segments[i]) > 0
+        }
+        if len(seg_priors) == 0:
             continue
 
-        hits.append({"target": index, "priors": priors})
+        hits.append({"target": int(index[i]), "priors": seg_priors})
 
     return hits
 
 
-@hydra.main(version_base=None, config_path="../config", config_name="filter")
-def main(cfg: DictConfig):
+def load_session(cfg, sinfo):
+    transcripts = {}
+    for i in range(1, 5):
+        pid = sinfo[f"pos{i}"]
+        fpath = cfg.transcript_file.format(
+            dataset=cfg.dataset, session=sinfo["session"], pid=f"pos{i}"
+        )
+        transcripts[pid] = load_json(fpath)
+
+    wearers, targets = get_wearer_targets(sinfo)
+
+    # Everything that does not depend on the filter settings, built once
+    return {
+        "session": sinfo["session"],
+        "transcripts": transcripts,
+        "wearers": list(wearers.values()),
+        "targets": targets,
+        "vad": OverlapIndex(transcripts),
+        "counts": {
+            pid: [count_words(seg["text"]) for seg in transcript]
+            for pid, transcript in transcripts.items()
+        },
+    }
+
+
+def session_hits(session, targ, min_words, max_words, prewindow):
+    targets = session["targets"]
+    partner = targets[int(targ == targets[0])]
+    dev_ts = filter_n_words(
+        session["transcripts"][targ], min_words, max_words, session["counts"][targ]
+    )
+    return filter_prewindow(
+        dev_ts, targ, session["vad"], partner, session["wearers"], prewindow
+    )
+
+
+def sweep(sessions, devices, grid, sweep_fpath):
+    names = ["min_words", "max_words", "prewindow"]
+    rows = []
+    for values in itertools.product(*[grid[x] for x in names]):
+        params = dict(zip(names, values))
+        for session in sessions:
+            for targ in session["targets"]:
+                n_hits = len(session_hits(session, targ, **params))
+                for device in devices:
+                    rows.append(
+                        {
+                            **params,
+                            "session": session["session"],
+                            "device": device,
+                            "target": targ,
+                            "hits": n_hits,
+                            "segments": len(session["transcripts"][targ]),
+                        }
+                    )
 
-    devices = ["aria", "ha"]
+    Path(sweep_fpath).parent.mkdir(parents=True, exist_ok=True)
+    with open(sweep_fpath, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    fstring = "{:<12}{:<12}{:<12}{:>8}{:>10}{:>8}"
+    print(fstring.format(*names, "hits", "segments", "yield"))
+    for values in itertools.product(*[grid[x] for x in names]):
+        combo = [x for x in rows if [x[n] for n in names] == list(values)]
+        n_hits = sum(x["hits"] for x in combo)
+        n_segments = sum(x["segments"] for x in combo)
+        fstring = "{:<12}{:<12}{:<12}{:>8}{:>10}{:>8.1%}"
+        print(fstring.format(*values, n_hits, n_segments, n_hits / max(n_segments, 1)))
+    print(f"Per session results written to {sweep_fpath}")
+
+
+def process_session(cfg, sinfo, devices):
+    session = load_session(cfg, sinfo)
+    transcripts = session["transcripts"]
+
+    log = []
+    for targ in session["targets"]:
+        # Hits do not depend on the device, so they are found once per target
+        hits = session_hits(session, targ, cfg.min_words, cfg.max_words, cfg.prewindow)
+        segments = extract_hits(transcripts, hits, targ)
 
-    # load sessions file
-    session_fpath = cfg.sessions_file.format(dataset=cfg.dataset)
-    session_info = load_csv(session_fpath)
-
-    min_words = cfg.min_words
-    max_words = cfg.max_words
-    prewindow = cfg.prewindow
+        for device in devices:
+            out_fpath = Path(
+                cfg.testable_file.format(
+                    dataset=cfg.dataset,
+                    session=sinfo["session"],
+                    device=device,
+                    pid=targ,
+                )
+            )
+            out_fpath.parent.mkdir(parents=True, exist_ok=True)
 
-    for sinfo in session_info:
+            with open(out_fpath, "w") as file:
+                json.dump(segments, file, indent=4)
 
-        transcripts = {}
-        pids = []
-        for i in range(1, 5):
-            pid = sinfo[f"pos{i}"]
-            pids.append(pid)
-            fpath = cfg.transcript_file.format(
-                dataset=cfg.dataset, session=sinfo["session"], pid=f"pos{i}"
+            log.append(
+                f"{sinfo['session']}.{device}.{targ} "
+                f"{len(segments)} {len(transcripts[targ])}"
             )
-            transcripts[pid] = load_json(fpath)
+    return log
 
-        wearers, targets = get_wearer_targets(sinfo)
 
-        vad = get_vad_array(transcripts)
+def map_sessions(fn, jobs, *iterables):
+    if jobs > 1:
+        # Results come back in session order whichever worker finishes first
+        with ProcessPoolExecutor(jobs) as pool:
+            return list(pool.map(fn, *iterables))
+    return list(map(fn, *iterables))
 
-        for device in devices:
-            for targ in targets:
-                partner = targets[int(targ == targets[0])]
-                dev_ts = transcripts[targ]
-                dev_ts = filter_n_words(dev_ts, min_words, max_words)
-                hits = filter_prewindow(
-                    dev_ts, targ, vad, partner, list(wearers.values()), prewindow
-                )
 
-                segments = extract_hits(transcripts, hits, targ)
+@hydra.main(version_base=None, config_path="../config", config_name="filter")
+def main(cfg: DictConfig):
 
-                out_fpath = Path(
-                    cfg.testable_file.format(
-                        dataset=cfg.dataset,
-                        session=sinfo["session"],
-                        device=device,
-                        pid=targ,
-                    )
-                )
-                out_fpath.parent.mkdir(parents=True, exist_ok=True)
+    devices = ["aria", "ha"]
 
-                with open(out_fpath, "w") as file:
-                    json.dump(segments, file, indent=4)
+    # load sessions file
+    session_fpath = cfg.sessions_file.format(dataset=cfg.dataset)
+    session_info = load_csv(session_fpath)
+    n_sessions = len(session_info)
 
-                print(
-                    f"{sinfo['session']}.{device}.{targ}",
-                    len(segments),
-                    len(transcripts[targ]),
-                )
+    if cfg.sweep is not None:
+        # Unswept parameters keep their configured value
+        grid = {
+            name: list(cfg.sweep.get(name, [cfg[name]]))
+            for name in ["min_words", "max_words", "prewindow"]
+        }
+        sessions = map_sessions(
+            load_session, cfg.jobs, [cfg] * n_sessions, session_info
+        )
+        sweep(sessions, devices, grid, cfg.sweep_file.format(dataset=cfg.dataset))
+        return
+
+    logs = map_sessions(
+        process_session,
+        cfg.jobs,
+        [cfg] * n_sessions,
+        session_info,
+        [devices] * n_sessions,
+    )
+    for log in logs:
+        for line in log:
+            print(line)
 
 
 if __name__ == "__main__":
@@ -3,9 +3,10 @@ import json
 from omegaconf import DictConfig
 from pathlib import Path
 import soundfile as sf
-import soxr
 from tqdm import tqdm
 
+from utils import read_window
+
 
 @hydra.main(version_base=None, config_path="../config", config_name="main")
 def main(cfg: DictConfig):
@@ -16,36 +17,38 @@ def main(cfg: DictConfig):
     with open(filtered_store, "r") as file:
         segments = json.load(file)
 
-    for seg in tqdm(segments):
+    # Group segments by session file so each file is only opened once
+    by_session = {}
+    for seg in segments:
         exp_fpath = exp_session_ftemplate.format(
             exp=cfg.experiment,
             session=seg["session"],
             device=seg["device"],
             pid=seg["target"],
         )
-
-        audio, fs = sf.read(exp_fpath)
-        if fs != 16000:
-            audio = soxr.resample(audio, fs, 16000)
-
-        start = seg["start"] - seg["start_pad"]
-        end = seg["end"] + seg["end_pad"]
-
-        snipper = audio[start:end]
-        output_fpath = filtered_file.format(
-            system=cfg.experiment,
-            device=seg["device"],
-            session=seg["session"],
-            pid=seg["target"],
-            seg=seg["segment_index"],
-            start=seg["start"],
-            end=seg["end"],
-        )
-        if not Path(output_fpath).parent.exists():
-            Path(output_fpath).parent.mkdir(parents=True)
-        sf.write(output_fpath, snipper, 16000)
-
-        seg[cfg.experiment] = output_fpath
+        by_session.setdefault(exp_fpath, []).append(seg)
+
+    for exp_fpath, session_segments in tqdm(by_session.items()):
+        with sf.SoundFile(exp_fpath) as exp_file:
+            for seg in session_segments:
+                start = seg["start"] - seg["start_pad"]
+                end = seg["end"] + seg["end_pad"]
+
+                snipper = read_window(exp_file, start, end, 16000)
+                output_fpath = filtered_file.format(
+                    system=cfg.experiment,
+                    device=seg["device"],
+                    session=seg["session"],
+                    pid=seg["target"],
+                    seg=seg["segment_index"],
+                    start=seg["start"],
+                    end=seg["end"],
+                )
+                if not Path(output_fpath).parent.exists():
+                    Path(output_fpath).parent.mkdir(parents=True)
+                sf.write(output_fpath, snipper, 16000)
+
+                seg[cfg.experiment] = output_fpath
 
     with open(filtered_store, "w") as file:
         json.dump(segments, file, indent=4)
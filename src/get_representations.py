@@ -2,51 +2,109 @@ import hydra
 import json
 from omegaconf import DictConfig
 from pathlib import Path
-import ppgs
+import soundfile as sf
 import torch
 import torchaudio
 from tqdm import tqdm
 
+from representations import get_extractor
+from utils import RepresentationStore, file_hash, segment_systems
+
+COMPACT_FRACTION = 0.25
+
+
+def load_mono(fpath):
+    audio, fs = torchaudio.load(fpath)
+    assert fs == 16000
+    if audio.shape[0] == 4:
+        audio = audio[:2, :].sum(dim=0, keepdim=True)
+    elif audio.shape[0] == 7:
+        audio = audio.narrow(0, 2, 1)
+    return audio
+
 
 def get_representations(
-    representation: str, filtered_store: str, output_dirtemplate: str
+    representations: str | list,
+    filtered_store: str,
+    output_dirtemplate: str,
+    batch_size: int = 8,
+    num_threads: int | None = None,
+    gpu: int | None = None,
 ):
 
+    if isinstance(representations, str):
+        representations = [representations]
+    extractors = [get_extractor(x) for x in representations]
+
     with open(filtered_store, "r") as file:
         filtered_segments = json.load(file)
 
-    output_dir = Path(
-        output_dirtemplate.format(dataset="dev", representation=representation)
-    )
-    if not output_dir.exists():
-        output_dir.mkdir(parents=True)
+    stores = {
+        extractor.name: RepresentationStore(
+            output_dirtemplate.format(dataset="dev", representation=extractor.name)
+        )
+        for extractor in extractors
+    }
+
+    # Every system's segment file shares its stem, so keys include the field
+    inputs = {}
+    for seg in filtered_segments:
+        for field in ["ref"] + segment_systems(seg):
+            in_fpath = Path(seg[field])
+            key = f"{field}/{in_fpath.stem}"
+            inputs[key] = in_fpath
+            for extractor in extractors:
+                seg[f"{field}_{extractor.name}"] = key
+
+    # Only recompute entries whose source audio or extractor settings changed
+    pending = []
+    for key, in_fpath in inputs.items():
+        source_hash = file_hash(in_fpath)
+        needed = []
+        for extractor in extractors:
+            stamp = f"{source_hash}:{extractor.key}"
+            if stores[extractor.name].stamp(key) != stamp:
+                needed.append((extractor.name, stamp))
+        if len(needed) > 0:
+            pending.append((key, in_fpath, needed))
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    # Sorting by length keeps the padding within each batch small
+    pending.sort(key=lambda x: sf.info(x[1]).frames)
 
-    for seg in tqdm(filtered_segments):
+    with tqdm(total=len(pending)) as progress:
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i : i + batch_size]
 
-        noisy = Path(seg["noisy"])
-        ref = Path(seg["ref"])
+            # Every extractor shares the one decoded buffer per file
+            audios = [load_mono(in_fpath) for _, in_fpath, _ in batch]
 
-        noisy_out = (output_dir / noisy.name).with_suffix(".pt")
-        ref_out = (output_dir / ref.name).with_suffix(".pt")
+            for extractor in extractors:
+                store = stores[extractor.name]
+                items = [
+                    (audio, key, str(in_fpath), stamp)
+                    for audio, (key, in_fpath, needed) in zip(audios, batch)
+                    for name, stamp in needed
+                    if name == extractor.name
+                ]
+                if len(items) == 0:
+                    continue
 
-        if representation == "ppg":
-            for in_fpath, out_fpath in zip([noisy, ref], [noisy_out, ref_out]):
-                audio, fs = torchaudio.load(in_fpath)
-                assert fs == 16000
-                if audio.shape[0] == 4:
-                    audio = audio[:2, :].sum(dim=0, keepdim=True)
-                elif audio.shape[0] == 7:
-                    audio = audio.narrow(0, 2, 1)
-                this_ppg = ppgs.from_audio(audio, fs)
-                torch.save(this_ppg, out_fpath)
+                values = extractor.extract_batch([x[0] for x in items], gpu)
+                for (_, key, source, stamp), value in zip(items, values):
+                    store.append(key, extractor.to_array(value), stamp, source)
 
-        else:
-            raise ValueError(
-                f"Representation {representation} not recognised. Add code here"
-            )
+            # Flushed after every batch so an interrupted run resumes from here
+            for store in stores.values():
+                store.flush()
+            progress.update(len(batch))
 
-        seg[f"noisy_{representation}"] = str(noisy_out)
-        seg[f"ref_{representation}"] = str(ref_out)
+    # Drop the superseded copies of recomputed entries once they add up
+    for store in stores.values():
+        if store.garbage() > COMPACT_FRACTION * store.size():
+            store.compact()
 
     with open(filtered_store, "w") as file:
         json.dump(filtered_segments, file, indent=4)
@@ -55,7 +113,12 @@ def get_representations(
 @hydra.main(version_base=None, config_path="../config", config_name="representation")
 def main(cfg: DictConfig):
     get_representations(
-        cfg.representation_type, cfg.filtered_store, cfg.representation_dir
+        cfg.representation_types,
+        cfg.filtered_store,
+        cfg.output_dir,
+        cfg.batch_size,
+        cfg.num_threads,
+        cfg.gpu,
     )
 
 
@@ -2,16 +2,32 @@ import json
 from hydra import initialize, compose
 from hydra.core.global_hydra import GlobalHydra
 import matplotlib.pyplot as plt
+import numpy as np
 import os
 import streamlit as st
 
+from scheduler import PLAN_SUFFIX, apply_plan, make_plan
+from utils import MediaCache, append_jsonl, load_json, load_jsonl, save_json
 from wer import plot_wer
 
 if "current" not in st.session_state:
     st.session_state.current = {"state": "instructions"}
 
 SEGMENTS = []
+INDEX = None
+MEDIA = None
 N_TRAINS = 3
+INSTRUCTION_PAGES = [
+    "Welcome",
+    "Volume",
+    "Task",
+    "Transcript",
+    "Effort",
+    "Training",
+    "Summary",
+    "Important",
+    "Begin",
+]
 
 
 @st.cache_resource
@@ -23,12 +39,51 @@ def load_config():
     return cfg
 
 
-@st.cache_data
-def load_segment_json(fpath):
+@st.cache_resource
+def load_media_cache(max_mb):
+    # One cache per server process, shared by every listener's session
+    return MediaCache(max_mb)
+
+
+class SegmentIndex:
+    # Segment positions in test order, shared read-only between listeners
+
+    def __init__(self, speakers):
+        self.speakers = speakers
+        counts = [len(x["segments"]) for x in speakers]
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(int)
+        self.offsets.flags.writeable = False
+        self.total = int(self.offsets[-1])
+        self.positions = {
+            seg["key"]: (speaker, sample)
+            for speaker, info in enumerate(speakers)
+            for sample, seg in enumerate(info["segments"])
+        }
+
+    def flat(self, speaker, sample):
+        return int(self.offsets[speaker]) + sample
+
+    def position(self, flat):
+        speaker = int(np.searchsorted(self.offsets, flat, side="right")) - 1
+        return speaker, flat - int(self.offsets[speaker])
+
+    def first_missing(self, keys):
+        # Position of the first segment whose key is not in keys, or None
+        done = np.zeros(self.total, dtype=bool)
+        for key in keys:
+            if key in self.positions:
+                done[self.flat(*self.positions[key])] = True
+        missing = np.flatnonzero(~done)
+        return self.position(int(missing[0])) if len(missing) > 0 else None
+
+
+@st.cache_resource
+def load_segment_index(fpath):
+    # Built once per server process rather than copied into every session
     with open(fpath, "r") as file:
         segments = json.load(file)
 
-    return segments
+    return SegmentIndex(segments)
 
 
 def get_current():
@@ -42,12 +97,20 @@ def encode_current(prep=""):
     return prep
 
 
+def journal_fpath(name):
+    # The journal is the record of every session, finished or not; the
+    # transcripts/{name}.json read by wer is only exported at the end
+    return f"transcripts/{name}.jsonl"
+
+
 def unique_name(name):
-    existing = os.listdir("transcripts")
+    existing = set(os.listdir("transcripts"))
     index = 0
     response = name
-    while f"{response}.json" in existing:
+    suffixes = [".json", ".jsonl", PLAN_SUFFIX]
+    while any(f"{response}{x}" in existing for x in suffixes):
         response = name + str(index)
+        index += 1
     return response
 
 
@@ -56,87 +119,108 @@ def append_save(response):
 
     current = get_current()
     seg = SEGMENTS[current["speaker"]]["segments"][current["sample"]]
-    st.session_state.responses["segments"].append(
-        {
-            "key": seg["key"],
-            "ground_truth": seg["ground_truth"],
-            "response": response[0],
-            "perceived_intel": response[1],
-            "commment": response[2],
-            "isTrain": current["isTrain"],
-        }
-    )
-
-    with open(f"transcripts/{player_name}.json", "w") as file:
-        json.dump(st.session_state.responses, file, indent=4)
+    record = {
+        "key": seg["key"],
+        "ground_truth": seg["ground_truth"],
+        "response": response[0],
+        "perceived_intel": response[1],
+        "commment": response[2],
+        "isTrain": current["isTrain"],
+    }
+    st.session_state.responses["segments"].append(record)
+    st.session_state.completed.add(seg["key"])
+
+    # One line per answer, so the cost of saving does not grow with the test
+    with open(journal_fpath(player_name), "a") as file:
+        append_jsonl(file, record)
+
+
+def export_responses(name):
+    # Writes the journal out in the transcripts/{name}.json format used by wer
+    responses = {"name": name, "segments": load_jsonl(journal_fpath(name))}
+    save_json(f"transcripts/{name}.json", responses)
+
+
+def assign_schedule(name):
+    # The order is fixed once per listener and saved so a resume keeps it
+    cfg = load_config()
+    speakers = load_segment_index(cfg.filtered_store).speakers
+    plan_fpath = f"transcripts/{name}{PLAN_SUFFIX}"
+    if os.path.exists(plan_fpath):
+        plan = load_json(plan_fpath)
+    else:
+        plan = make_plan(
+            speakers, cfg.schedule, "transcripts", name, cfg.schedule_seed, N_TRAINS
+        )
+        save_json(plan_fpath, plan)
+    st.session_state.index = SegmentIndex(apply_plan(speakers, plan))
 
 
 def check_continue():
     player_name = st.session_state.responses["name"]
 
-    fpath = f"transcripts/{player_name}.json"
+    fpath = journal_fpath(player_name)
+
+    assign_schedule(player_name)
+    index = st.session_state.index
 
     if not os.path.exists(fpath):
         return {"state": "rainbow", "speaker": 0}
 
-    with open(fpath, "r") as file:
-        responses = json.load(file)
-    keys = [x["key"] for x in responses["segments"]]
-    st.session_state.responses = responses
-    for spk, info in enumerate(SEGMENTS):
-        for sample, seg in enumerate(info["segments"]):
-            if seg["key"] not in keys:
-                isTrain = sample < N_TRAINS
-                return {
-                    "state": "training" if isTrain else "testing",
-                    "speaker": spk,
-                    "sample": sample,
-                    "isTrain": False,
-                }
-    print("All segments already seen")
-    return {"state": "end"}
+    segments = load_jsonl(fpath)
+    st.session_state.responses = {"name": player_name, "segments": segments}
+    st.session_state.completed = {x["key"] for x in segments}
+    position = index.first_missing(st.session_state.completed)
+    if position is None:
+        print("All segments already seen")
+        export_responses(player_name)
+        return {"state": "end"}
+
+    spk, sample = position
+    isTrain = sample < N_TRAINS
+    return {
+        "state": "training" if isTrain else "testing",
+        "speaker": spk,
+        "sample": sample,
+        "isTrain": False,
+    }
+
+
+@st.cache_resource
+def load_markdown():
+    pages = {}
+    for page in INSTRUCTION_PAGES:
+        with open(f"src/markdown/{page.lower()}.md", "r") as file:
+            pages[page] = file.read()
+    return pages
 
 
 def instructions(rainbow_ftemplate, segment_ftemplate):
-    tab_md = [
-        "Welcome",
-        "Volume",
-        "Task",
-        "Transcript",
-        "Effort",
-        "Training",
-        "Summary",
-        "Important",
-        "Begin",
-    ]
-
-    stabs = st.tabs(tab_md)
-    for tmd, tab in zip(tab_md, stabs):
-        tmd = tmd.lower()
-        with open(f"src/markdown/{tmd}.md", "r") as file:
-            text = file.read()
-        tab.markdown(text)
-
-        if tmd == "begin":
-            name = tab.text_input("Name")
-            tab.button(
-                "Continue", on_click=continue_test, args=[name], disabled=len(name) == 0
-            )
-        elif tmd in ["volume", "task", "transcript", "effort", "training"]:
-            with tab:
-                if tmd == "training":
-                    show_rainbow(rainbow_ftemplate, True)
-                show_sample(segment_ftemplate, tmd)
+    # Only the selected page is rendered, so typing a name does not redraw
+    # every page's demo media
+    page = st.radio(
+        "Page",
+        INSTRUCTION_PAGES,
+        horizontal=True,
+        label_visibility="collapsed",
+        key="instruction_page",
+    )
+    st.markdown(load_markdown()[page])
 
+    tmd = page.lower()
+    if tmd == "begin":
+        name = st.text_input("Name")
+        st.button(
+            "Continue", on_click=continue_test, args=[name], disabled=len(name) == 0
+        )
+    elif tmd in ["volume", "task", "transcript", "effort", "training"]:
+        if tmd == "training":
+            show_rainbow(rainbow_ftemplate, True)
+        show_sample(segment_ftemplate, tmd)
 
-def progress(speaker, index):
-    total = sum(len(x["segments"]) for x in SEGMENTS)
-    count = 0
-    for i in range(speaker):
-        count += len(SEGMENTS[i]["segments"])
-    count += index
 
-    st.progress(count / total, "Progress")
+def progress(speaker, index):
+    st.progress(INDEX.flat(speaker, index) / INDEX.total, "Progress")
 
 
 def show_rainbow(rainbow_ftemplate, dummy=False):
@@ -148,12 +232,63 @@ def show_rainbow(rainbow_ftemplate, dummy=False):
     if not dummy:
         progress(speaker, 0)
 
-    pid = SEGMENTS[speaker]["pid"]
     st.header("Clean speech sample for the target")
     st.write(
         "Please listen to the target speaker's voice (recorded without background noise or interfering speakers)."
     )
-    st.audio(rainbow_ftemplate.format(dataset="dev", pid=pid))
+    st.audio(MEDIA.get(rainbow_fpath(rainbow_ftemplate, speaker)))
+
+
+def rainbow_fpath(rainbow_ftemplate, speaker):
+    return rainbow_ftemplate.format(dataset="dev", pid=SEGMENTS[speaker]["pid"])
+
+
+def segment_fpath(segment_ftemplate, speaker, index):
+    info = SEGMENTS[speaker]
+    return segment_ftemplate.format(
+        dataset="dev",
+        exp=info["experiment"],
+        session=info["session"],
+        device=info["device"],
+        pid=info["pid"],
+        seg=info["segments"][index]["index"],
+        anim=st.session_state.anim_type,
+    )
+
+
+def upcoming(speaker, sample, count):
+    # Media the listener reaches next; sample is None on a rainbow clip
+    index = 0 if sample is None else sample + 1
+    while count > 0 and speaker < len(SEGMENTS):
+        if index >= len(SEGMENTS[speaker]["segments"]):
+            speaker, index = speaker + 1, 0
+            if speaker < len(SEGMENTS):
+                yield "rainbow", speaker, None
+            continue
+        yield "segment", speaker, index
+        index += 1
+        count -= 1
+
+
+def prefetch(segment_ftemplate, rainbow_ftemplate, n_ahead):
+    # The order is only known once the listener's schedule is assigned
+    current = get_current()
+    if current["state"] == "end" or "index" not in st.session_state:
+        return
+    speaker, sample = current["speaker"], current.get("sample")
+
+    fpaths = []
+    for kind, spk, index in upcoming(speaker, sample, n_ahead):
+        if kind == "rainbow":
+            fpaths.append(rainbow_fpath(rainbow_ftemplate, spk))
+        else:
+            fpaths.append(segment_fpath(segment_ftemplate, spk, index))
+
+    # The next speaker's rainbow clip, even when it is further than n_ahead
+    if speaker + 1 < len(SEGMENTS):
+        fpaths.append(rainbow_fpath(rainbow_ftemplate, speaker + 1))
+
+    MEDIA.prefetch(fpaths)
 
 
 def show_sample(segment_ftemplate, dummy_stage=None):
@@ -192,21 +327,7 @@ def show_sample(segment_ftemplate, dummy_stage=None):
 
     info = SEGMENTS[speaker]
     segment = info["segments"][index]
-
-    session = info["session"]
-    device = info["device"]
-    pid = info["pid"]
-    exp = info["experiment"]
-
-    fpath = segment_ftemplate.format(
-        dataset="dev",
-        exp=exp,
-        session=session,
-        device=device,
-        pid=pid,
-        seg=segment["index"],
-        anim=st.session_state.anim_type,
-    )
+    fpath = segment_fpath(segment_ftemplate, speaker, index)
 
     current = get_current()
     if dummy_stage == "trainsamp":
@@ -262,7 +383,7 @@ def show_sample(segment_ftemplate, dummy_stage=None):
     else:
         perceived = 0
 
-    st.video(fpath, "video/mp4")
+    st.video(MEDIA.get(fpath), "video/mp4")
     comment = ""
 
     return response, perceived, comment
@@ -277,6 +398,8 @@ def continue_test(response):
         st.session_state.current["speaker"] = 0
         response = unique_name(response)
         st.session_state.responses = {"name": response, "segments": []}
+        st.session_state.completed = set()
+        assign_schedule(response)
     elif state == "rainbow":
         st.session_state.current = {
             "state": "training",
@@ -314,6 +437,7 @@ def continue_test(response):
         else:
             # Finished all speakers, ending test
             st.session_state.current = {"state": "end"}
+            export_responses(st.session_state.responses["name"])
 
 
 def end_window(cfg):
@@ -327,11 +451,17 @@ def end_window(cfg):
 
 
 def main():
-    global SEGMENTS
+    global SEGMENTS, INDEX, MEDIA
 
     cfg = load_config()
 
-    SEGMENTS = load_segment_json(cfg.filtered_store)
+    # Listeners see the segments in their scheduled order once they start
+    if "index" in st.session_state:
+        INDEX = st.session_state.index
+    else:
+        INDEX = load_segment_index(cfg.filtered_store)
+    SEGMENTS = INDEX.speakers
+    MEDIA = load_media_cache(cfg.media_cache_mb)
 
     if "anim_type" not in st.session_state:
         st.session_state.anim_type = "targetwave"
@@ -353,6 +483,9 @@ def main():
     else:
         raise ValueError(f"Invalid state: {get_current()}")
 
+    # Read the next items into memory while the listener works on this one
+    prefetch(cfg.exp_segment_video, cfg.test_rainbow_file, cfg.prefetch)
+
     if state == "end":
         name = st.session_state.responses["name"]
         data = json.dumps(st.session_state.responses)
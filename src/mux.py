@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import subprocess
+
+from utils import file_hash, load_json, save_json
+
+MANIFEST_NAME = ".mux_hashes.json"
+FFMPEG = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error"]
+
+
+def job_hash(job):
+    anim_fpath, audio_fpath, _ = job
+    return file_hash(anim_fpath) + file_hash(audio_fpath)
+
+
+def load_manifest(out_dir: Path):
+    fpath = out_dir / MANIFEST_NAME
+    if not fpath.exists():
+        return {}
+    return load_json(fpath)
+
+
+def mux_command(jobs):
+    # One ffmpeg call muxing every (animation, audio, output) job in jobs
+    cmd = list(FFMPEG)
+    for anim_fpath, audio_fpath, _ in jobs:
+        cmd += ["-i", str(anim_fpath), "-i", str(audio_fpath)]
+    for i, (_, _, out_fpath) in enumerate(jobs):
+        cmd += ["-map", f"{2 * i}:v", "-map", f"{2 * i + 1}:a"]
+        cmd += ["-c:v", "copy", "-c:a", "aac", str(out_fpath)]
+    return cmd
+
+
+def run_batch(jobs):
+    # Retry jobs one by one if the batch fails, to find which ones broke it
+    result = subprocess.run(mux_command(jobs), capture_output=True, text=True)
+    if result.returncode == 0:
+        return []
+    if len(jobs) == 1:
+        return [(str(jobs[0][2]), result.stderr.strip())]
+
+    failures = []
+    for job in jobs:
+        failures += run_batch([job])
+    return failures
+
+
+def run_mux_jobs(jobs, max_workers=4, batch_size=16, overwrite=False):
+    # Outputs are skipped while their inputs hash to the manifest's values
+    jobs = [(Path(a), Path(b), Path(c)) for a, b, c in jobs]
+    manifests = {}
+    for job in jobs:
+        out_dir = job[2].parent
+        if out_dir not in manifests:
+            manifests[out_dir] = load_manifest(out_dir)
+
+    def safe_hash(job):
+        try:
+            return job_hash(job)
+        except OSError as err:
+            return err
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        hashes = list(pool.map(safe_hash, jobs))
+
+        pending = []
+        failures = [
+            (str(j[2]), str(h)) for j, h in zip(jobs, hashes) if isinstance(h, OSError)
+        ]
+        n_unreadable = len(failures)
+        for job, digest in zip(jobs, hashes):
+            out_fpath = job[2]
+            if isinstance(digest, OSError):
+                continue
+            recorded = manifests[out_fpath.parent].get(out_fpath.name)
+            if overwrite or not out_fpath.exists() or recorded != digest:
+                out_fpath.parent.mkdir(parents=True, exist_ok=True)
+                pending.append((job, digest))
+
+        batches = [
+            [job for job, _ in pending[i : i + batch_size]]
+            for i in range(0, len(pending), batch_size)
+        ]
+        for batch_failures in pool.map(run_batch, batches):
+            failures += batch_failures
+
+    failed = {x[0] for x in failures}
+    for (_, _, out_fpath), digest in pending:
+        if str(out_fpath) not in failed:
+            manifests[out_fpath.parent][out_fpath.name] = digest
+    for out_dir, manifest in manifests.items():
+        if out_dir.exists():
+            save_json(out_dir / MANIFEST_NAME, manifest)
+
+    n_muxed = sum(str(job[2]) not in failed for job, _ in pending)
+    n_skipped = len(jobs) - len(pending) - n_unreadable
+    return n_muxed, n_skipped, failures
@@ -0,0 +1,118 @@
+from abc import ABC, abstractmethod
+import numpy as np
+import ppgs
+import torch
+import torchaudio
+
+from utils import lookup
+
+SAMPLE_RATE = 16000
+
+
+class Representation(ABC):
+    # Extracts from a (1, samples) 16 kHz waveform; key changes force a rerun
+
+    name = None
+    dtype = np.float32
+
+    @property
+    def key(self):
+        return self.name
+
+    @abstractmethod
+    def extract(self, audio, gpu=None):
+        pass
+
+    def extract_batch(self, audios, gpu=None):
+        return [self.extract(audio, gpu) for audio in audios]
+
+    def to_array(self, value) -> np.ndarray:
+        if isinstance(value, torch.Tensor):
+            value = value.detach().cpu().numpy()
+        return np.asarray(value, dtype=self.dtype)
+
+
+class PPG(Representation):
+    name = "ppg"
+
+    @property
+    def key(self):
+        return f"{self.name}-{ppgs.REPRESENTATION}"
+
+    def extract(self, audio, gpu=None):
+        return self.extract_batch([audio], gpu)[0]
+
+    def extract_batch(self, audios, gpu=None):
+        lengths = torch.tensor([x.shape[-1] for x in audios])
+        padded = torch.zeros(len(audios), 1, int(lengths.max()))
+        for i, audio in enumerate(audios):
+            padded[i, :, : audio.shape[-1]] = audio
+
+        # Same batched path as ppgs.from_dataloader, masked by the true lengths
+        frame_lengths = lengths // ppgs.HOPSIZE
+        features = getattr(ppgs.preprocess, ppgs.REPRESENTATION).from_audios(
+            padded, lengths, gpu=gpu
+        )
+        result = ppgs.from_features(features, frame_lengths, gpu=gpu).cpu()
+
+        return [result[i : i + 1, :, :n].clone() for i, n in enumerate(frame_lengths)]
+
+
+class LogMel(Representation):
+    name = "logmel"
+
+    def __init__(self, n_mels=80, n_fft=400, hop=160):
+        self.params = (n_mels, n_fft, hop)
+        self.transform = torchaudio.transforms.MelSpectrogram(
+            SAMPLE_RATE, n_fft=n_fft, hop_length=hop, n_mels=n_mels
+        )
+
+    @property
+    def key(self):
+        return f"{self.name}-{'-'.join(str(x) for x in self.params)}"
+
+    def extract(self, audio, gpu=None):
+        return torch.log(self.transform(audio) + 1e-6)
+
+
+class MFCC(Representation):
+    name = "mfcc"
+
+    def __init__(self, n_mfcc=13, n_mels=40, n_fft=400, hop=160):
+        self.params = (n_mfcc, n_mels, n_fft, hop)
+        self.transform = torchaudio.transforms.MFCC(
+            SAMPLE_RATE,
+            n_mfcc=n_mfcc,
+            melkwargs={"n_fft": n_fft, "hop_length": hop, "n_mels": n_mels},
+        )
+
+    @property
+    def key(self):
+        return f"{self.name}-{'-'.join(str(x) for x in self.params)}"
+
+    def extract(self, audio, gpu=None):
+        return self.transform(audio)
+
+
+class Energy(Representation):
+    name = "energy"
+
+    def __init__(self, window=400, hop=160):
+        self.params = (window, hop)
+
+    @property
+    def key(self):
+        return f"{self.name}-{'-'.join(str(x) for x in self.params)}"
+
+    def extract(self, audio, gpu=None):
+        window, hop = self.params
+        frames = audio[0].unfold(0, window, hop)
+        rms = torch.sqrt(torch.mean(torch.square(frames), dim=-1))
+        return (20 * torch.log10(rms + 1e-5)).numpy()
+
+
+REPRESENTATIONS = {x.name: x for x in [PPG, LogMel, MFCC, Energy]}
+
+
+def get_extractor(name: str) -> Representation:
+    return lookup(REPRESENTATIONS, name, "Representation")()
@@ -0,0 +1,129 @@
+from collections import Counter
+from pathlib import Path
+import random
+
+from utils import load_json, load_jsonl, lookup
+
+PLAN_SUFFIX = ".plan.json"
+
+
+def response_files(transcript_dir):
+    # Each listener's responses, preferring the journal over an exported JSON
+    files = {}
+    for fpath in sorted(Path(transcript_dir).glob("*.json*")):
+        if fpath.name.endswith(PLAN_SUFFIX) or fpath.suffix not in [".json", ".jsonl"]:
+            continue
+        if fpath.suffix == ".jsonl" or fpath.stem not in files:
+            files[fpath.stem] = fpath
+    return files
+
+
+def load_responses(fpath):
+    if fpath.suffix == ".jsonl":
+        return load_jsonl(fpath)
+    return load_json(fpath)["segments"]
+
+
+def response_counts(transcript_dir):
+    counts = Counter()
+    for fpath in response_files(transcript_dir).values():
+        counts.update(x["key"] for x in load_responses(fpath) if not x["isTrain"])
+    return counts
+
+
+def n_listeners(transcript_dir):
+    # Listeners with a plan or any responses, so concurrent starts still rotate
+    names = set(response_files(transcript_dir))
+    names |= {
+        x.name[: -len(PLAN_SUFFIX)]
+        for x in Path(transcript_dir).glob(f"*{PLAN_SUFFIX}")
+    }
+    return len(names)
+
+
+def fixed(speakers, n_trains, context):
+    return [
+        (speaker, list(range(len(info["segments"]))))
+        for speaker, info in enumerate(speakers)
+    ]
+
+
+def shuffled(speakers, n_trains, context):
+    rng = random.Random(f"{context['seed']}:{context['name']}")
+    plan = []
+    for speaker, info in enumerate(speakers):
+        tests = list(range(n_trains, len(info["segments"])))
+        rng.shuffle(tests)
+        plan.append((speaker, list(range(n_trains)) + tests))
+    rng.shuffle(plan)
+    return plan
+
+
+def latin(speakers, n_trains, context):
+    # Listener n starts on the n-th experiment and the n-th test sample, so
+    # over len(experiments) listeners each experiment appears in each slot
+    n = n_listeners(context["transcript_dir"])
+
+    by_experiment = {}
+    for speaker, info in enumerate(speakers):
+        by_experiment.setdefault(info["experiment"], []).append(speaker)
+    experiments = sorted(by_experiment)
+    shift = n % len(experiments)
+    experiments = experiments[shift:] + experiments[:shift]
+
+    plan = []
+    for turn in range(max(len(x) for x in by_experiment.values())):
+        for experiment in experiments:
+            if turn >= len(by_experiment[experiment]):
+                continue
+            speaker = by_experiment[experiment][turn]
+            tests = list(range(n_trains, len(speakers[speaker]["segments"])))
+            if len(tests) > 0:
+                shift = n % len(tests)
+                tests = tests[shift:] + tests[:shift]
+            plan.append((speaker, list(range(n_trains)) + tests))
+    return plan
+
+
+def adaptive(speakers, n_trains, context):
+    counts = response_counts(context["transcript_dir"])
+
+    plan = []
+    for speaker, info in enumerate(speakers):
+        tests = list(range(n_trains, len(info["segments"])))
+        tests.sort(key=lambda i: counts[info["segments"][i]["key"]])
+        plan.append((speaker, list(range(n_trains)) + tests))
+
+    # Speakers whose test segments have the fewest responses come first
+    def mean_count(item):
+        speaker, samples = item
+        keys = [speakers[speaker]["segments"][i]["key"] for i in samples[n_trains:]]
+        return sum(counts[x] for x in keys) / max(len(keys), 1)
+
+    plan.sort(key=mean_count)
+    return plan
+
+
+STRATEGIES = {
+    "fixed": fixed,
+    "random": shuffled,
+    "latin": latin,
+    "adaptive": adaptive,
+}
+
+
+def make_plan(speakers, strategy, transcript_dir, name, seed=0, n_trains=3):
+    # (speaker, samples) pairs for a new listener, training samples first
+    schedule = lookup(STRATEGIES, strategy, "Schedule")
+    context = {"transcript_dir": transcript_dir, "name": name, "seed": seed}
+    return [list(x) for x in schedule(speakers, n_trains, context)]
+
+
+def apply_plan(speakers, plan):
+    return [
+        {
+            **speakers[speaker],
+            "segments": [speakers[speaker]["segments"][i] for i in samples],
+        }
+        for speaker, samples in plan
+    ]
@@ -1,62 +1,301 @@
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
 import hydra
 import json
+from math import nan
 from omegaconf import DictConfig
+import os
 from pathlib import Path
 import ppgs
 from pysepm.qualityMeasures import fwSNRseg, composite
 from pystoi import stoi
+from pystoi.utils import resample_oct
 import soundfile as sf
+import time
 import torch
 from tqdm import tqdm
 
+from utils import (
+    RepresentationStore,
+    append_jsonl,
+    load_json,
+    load_jsonl,
+    lookup,
+    save_json,
+    segment_systems,
+)
 
-def score_filtered(filtered_store):
+STOI_FS = 10000
 
-    with open(filtered_store, "r") as file:
-        filtered_segments = json.load(file)
+# One store per worker process, opened on first use
+PPG_STORES = {}
 
-    for seg in tqdm(filtered_segments):
-        noisy, nfs = sf.read(seg["noisy"])
-        ref, rfs = sf.read(seg["ref"])
 
-        assert nfs == 16000
-        assert rfs == 16000
+def score_key(system, name):
+    # Noisy scores keep their original, unprefixed names
+    return name if system == "noisy" else f"{system}_{name}"
 
-        if noisy.shape[1] == 4:
-            noisy = noisy[:, 0] + noisy[:, 1]
+
+def load_signal(fpath):
+    audio, fs = sf.read(fpath)
+    assert fs == 16000
+
+    if audio.ndim == 1:
+        return audio, fs
+    if audio.shape[1] == 4:
+        return audio[:, 0] + audio[:, 1], fs
+    if audio.shape[1] == 7:
+        return audio[:, 2], fs
+    raise ValueError(f"Cannot score {audio.shape[1]} channel audio in {fpath}")
+
+
+class SegmentAudio:
+    # Signals of one segment, each decoded on first use and then shared
+
+    def __init__(self, seg):
+        self.seg = seg
+        self.signals = {}
+
+    def __getitem__(self, field):
+        if field not in self.signals:
+            self.signals[field] = load_signal(self.seg[field])
+        return self.signals[field]
+
+    def resampled(self, field, fs):
+        if (field, fs) not in self.signals:
+            audio, native_fs = self[field]
+            self.signals[(field, fs)] = resample_oct(audio, fs, native_fs)
+        return self.signals[(field, fs)]
+
+
+def score_stoi(audio, system, representation_dir):
+    # Same as stoi(ref, deg, 16000), but the reference is resampled only once
+    ref = audio.resampled("ref", STOI_FS)
+    deg = audio.resampled(system, STOI_FS)
+    return {"stoi": stoi(ref, deg, STOI_FS)}
+
+
+def score_fwsegsnr(audio, system, representation_dir):
+    ref, fs = audio["ref"]
+    deg, _ = audio[system]
+    return {"fwsegsnr": fwSNRseg(ref, deg, fs)}
+
+
+def score_composite(audio, system, representation_dir):
+    ref, fs = audio["ref"]
+    deg, _ = audio[system]
+    csig, cbak, covl = composite(ref, deg, fs)
+    return {"Csig": csig, "Cbak": cbak, "Covl": covl}
+
+
+def get_ppg_store(representation_dir):
+    if representation_dir not in PPG_STORES:
+        PPG_STORES[representation_dir] = RepresentationStore(
+            representation_dir.format(dataset="dev", representation="ppg")
+        )
+    return PPG_STORES[representation_dir]
+
+
+def score_ppg_js(audio, system, representation_dir):
+    ppg_store = get_ppg_store(representation_dir)
+
+    deg_ppg = torch.from_numpy(ppg_store[audio.seg[f"{system}_ppg"]])
+    ref_ppg = torch.from_numpy(ppg_store[audio.seg["ref_ppg"]])
+
+    dist = ppgs.distance(deg_ppg.squeeze(0), ref_ppg.squeeze(0))
+    return {"ppg_js": dist.item()}
+
+
+def audio_inputs(seg, system, representation_dir):
+    # Size and modification time, so checking inputs never reads the audio
+    stats = [os.stat(seg[field]) for field in [system, "ref"]]
+    return [f"{x.st_size}:{x.st_mtime_ns}" for x in stats]
+
+
+def ppg_inputs(seg, system, representation_dir):
+    ppg_store = get_ppg_store(representation_dir)
+    keys = [seg.get(f"{system}_ppg"), seg.get("ref_ppg")]
+    if any(key not in ppg_store for key in keys):
+        return None
+    return [ppg_store.stamp(key) for key in keys]
+
+
+# Metric name -> (scoring function, keys it writes, what its inputs are, or
+# None when they are not available for a system)
+METRICS = {
+    "stoi": (score_stoi, ["stoi"], audio_inputs),
+    "fwsegsnr": (score_fwsegsnr, ["fwsegsnr"], audio_inputs),
+    "composite": (score_composite, ["Csig", "Cbak", "Covl"], audio_inputs),
+    "ppg_js": (score_ppg_js, ["ppg_js"], ppg_inputs),
+}
+
+
+def fingerprint(seg, system, metric, representation_dir):
+    inputs = METRICS[metric][2](seg, system, representation_dir)
+    if inputs is None:
+        return None
+    return hashlib.sha1(json.dumps(inputs).encode()).hexdigest()[:16]
+
+
+def needs_score(seg, system, metric, current):
+    keys = [score_key(system, key) for key in METRICS[metric][1]]
+    inputs = seg.setdefault("score_inputs", {})
+    input_key = score_key(system, metric)
+    if any(key not in seg for key in keys):
+        return True
+    if input_key not in inputs:
+        # Scored before inputs were recorded; trust it and start tracking
+        inputs[input_key] = current
+        return False
+    return inputs[input_key] != current
+
+
+def score_segment(index, seg, tasks, representation_dir):
+    # Every system of the segment is scored here, so the reference is
+    # decoded once however many systems are compared against it
+    audio = SegmentAudio(seg)
+    results = []
+    for metric, system, inputs in tasks:
+        start = time.perf_counter()
+        scores = METRICS[metric][0](audio, system, representation_dir)
+        scores = {score_key(system, key): value for key, value in scores.items()}
+        results.append((metric, system, scores, inputs, time.perf_counter() - start))
+    return index, results
+
+
+def print_timing(timing, counts, wall):
+    print("{:<12}{:>8}{:>12}{:>12}".format("metric", "scores", "total (s)", "mean (s)"))
+    for metric in METRICS:
+        n, seconds = counts[metric], timing[metric]
+        if n == 0:
+            continue
+        print("{:<12}{:>8}{:>12.1f}{:>12.3f}".format(metric, n, seconds, seconds / n))
+    print(f"Wall time {wall:.1f} s for {sum(timing.values()):.1f} s of scoring")
+
+
+def replay_journal(filtered_segments, journal):
+    positions = {Path(seg["noisy"]).stem: i for i, seg in enumerate(filtered_segments)}
+    n_replayed = 0
+    for record in load_jsonl(journal):
+        if record["segment"] in positions:
+            seg = filtered_segments[positions[record["segment"]]]
+            seg.update(record["scores"])
+            seg.setdefault("score_inputs", {})[record["metric"]] = record["inputs"]
+            n_replayed += 1
+    return n_replayed
+
+
+def score_filtered(
+    filtered_store, representation_dir, journal, metrics, systems=None, jobs=1
+):
+
+    for metric in metrics:
+        lookup(METRICS, metric, "Metric")
+    filtered_segments = load_json(filtered_store)
+
+    # Scores from an interrupted run are recovered before deciding what to do
+    n_replayed = replay_journal(filtered_segments, journal)
+    if n_replayed > 0:
+        print(f"Recovered {n_replayed} scores from {journal}")
+
+    # One job per segment, covering each system and requested metric that is
+    # missing or whose inputs changed since it was scored
+    pending = {}
+    scored_systems = []
+    unavailable = defaultdict(int)
+    for i, seg in enumerate(filtered_segments):
+        seg_systems = segment_systems(seg)
+        if systems is not None:
+            seg_systems = [x for x in systems if x in seg_systems]
+        for system in seg_systems:
+            if system not in scored_systems:
+                scored_systems.append(system)
+            for metric in metrics:
+                inputs = fingerprint(seg, system, metric, representation_dir)
+                if inputs is None:
+                    unavailable[(system, metric)] += 1
+                elif needs_score(seg, system, metric, inputs):
+                    pending.setdefault(i, []).append((metric, system, inputs))
+
+    for (system, metric), n in unavailable.items():
+        print(f"Skipping {metric} for {system} on {n} segments without its inputs")
+
+    timing = defaultdict(float)
+    counts = defaultdict(int)
+    start = time.perf_counter()
+
+    with open(journal, "a") as journal_file:
+        if journal_file.tell() > 0:
+            # Starts a fresh line in case the last record was cut short
+            journal_file.write("\n")
+
+        def merge(index, results):
+            seg = filtered_segments[index]
+            for metric, system, scores, inputs, seconds in results:
+                seg.update(scores)
+                seg["score_inputs"][score_key(system, metric)] = inputs
+                record = {
+                    "segment": Path(seg["noisy"]).stem,
+                    "metric": score_key(system, metric),
+                    "scores": scores,
+                    "inputs": inputs,
+                }
+                append_jsonl(journal_file, record)
+                timing[metric] += seconds
+                counts[metric] += 1
+
+        if jobs > 1:
+            # Workers only compute; every result is merged here, in this process
+            with ProcessPoolExecutor(jobs) as pool:
+                futures = [
+                    pool.submit(
+                        score_segment,
+                        i,
+                        filtered_segments[i],
+                        tasks,
+                        representation_dir,
+                    )
+                    for i, tasks in pending.items()
+                ]
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    merge(*future.result())
         else:
-            noisy = noisy[:, 2]
-
-        if "stoi" not in seg:
-            seg["stoi"] = stoi(ref, noisy, nfs)
-        if "fwsegsnr" not in seg:
-            seg["fwsegsnr"] = fwSNRseg(ref, noisy, nfs)
-        if "Csig" not in seg:
-            csig, cbak, covl = composite(ref, noisy, nfs)
-            seg["Csig"] = csig
-            seg["Cbak"] = cbak
-            seg["Covl"] = covl
-        if "ppg_js" not in seg:
-            noisy_ppg = torch.load(seg["noisy_ppg"])
-            ref_ppg = torch.load(seg["ref_ppg"])
-
-            dist = ppgs.distance(noisy_ppg.squeeze(0), ref_ppg.squeeze(0))
-            seg["ppg_js"] = dist.item()
-
-    with open(filtered_store, "w") as file:
-        json.dump(filtered_segments, file, indent=4)
-
-    print_mets = ["ppg_js", "stoi", "fwsegsnr", "Csig", "Cbak", "Covl"]
-
-    for thing in filtered_segments:
-        name = Path(thing["noisy"]).stem
+            for i, tasks in tqdm(pending.items()):
+                merge(
+                    *score_segment(i, filtered_segments[i], tasks, representation_dir)
+                )
+
+    # Compact the journal into the store; it is only emptied once that is saved
+    save_json(filtered_store, filtered_segments)
+    os.remove(journal)
+
+    if len(pending) > 0:
+        print_timing(timing, counts, time.perf_counter() - start)
+
+    print_mets = [key for metric in metrics for key in METRICS[metric][1]]
+    for system in scored_systems:
+        header = "{:<50}" + "{:<10}" * len(print_mets)
+        print(header.format(system, *print_mets))
         fstring = "{:<50}" + "{:<10.2f}" * len(print_mets)
-        print(fstring.format(name, *[thing[met] for met in print_mets]))
+        for thing in filtered_segments:
+            if system not in thing:
+                continue
+            name = Path(thing["noisy"]).stem
+            scores = [thing.get(score_key(system, met), nan) for met in print_mets]
+            print(fstring.format(name, *scores))
 
 
 @hydra.main(version_base=None, config_path="../config", config_name="score")
 def main(cfg: DictConfig):
-    score_filtered(cfg.filtered_store)
+    score_filtered(
+        cfg.filtered_store,
+        cfg.representation_dir,
+        cfg.score_journal,
+        cfg.metrics,
+        cfg.systems,
+        cfg.jobs,
+    )
 
 
 if __name__ == "__main__":
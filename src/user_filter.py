@@ -7,7 +7,7 @@ import os
 from pathlib import Path
 import soundfile as sf
 
-from utils import load_refaudio, rms_norm
+from utils import AudioCache, load_refaudio, rms_norm
 
 TARGET_FS = 16000
 MIN_DURATION = TARGET_FS * 2
@@ -22,6 +22,7 @@ def user_filter(
     session_ref_template: str,
     rainbow_template: str,
     filtered_store: str,
+    cache: AudioCache | None = None,
 ):
 
     if not Path(filtered_store).exists():
@@ -83,6 +84,7 @@ def user_filter(
         session,
         device,
         [f"pos{i}" for i in range(1, 5) if i != wearer_pos],
+        cache=cache,
     )
 
     while len(filtered_segments[-1]["segments"]) < TARGET_SEGMENTS:
@@ -138,6 +140,7 @@ def main(cfg: DictConfig):
         cfg.ref_session_file,
         cfg.rainbow_file,
         cfg.filtered_store,
+        AudioCache(cfg.audio_cache_dir, cfg.audio_cache_max_gb),
     )
 
 
@@ -1,39 +1,318 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import csv
+import hashlib
 import json
+import math
 import numpy as np
+import os
 from pathlib import Path
 import soundfile as sf
 import soxr
+import struct
+import threading
 from typing import Tuple
 
+BLOCKSIZE = 2**18
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+class AudioCache:
+    # Decoded float32 audio as .npy files, evicted least recently used first
+
+    def __init__(self, cache_dir: str | Path, max_gb: float = 20.0):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = int(max_gb * 1e9)
+
+    def key(self, fpaths, target_sr, channels=None, normalize=None) -> str:
+        if isinstance(fpaths, (str, Path)):
+            fpaths = [fpaths]
+        parts = [target_sr, channels, normalize]
+        for fpath in fpaths:
+            fpath = Path(fpath).resolve()
+            parts += [str(fpath), os.stat(fpath).st_mtime_ns]
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def get(self, key: str):
+        fpath = self.cache_dir / f"{key}.npy"
+        if not fpath.exists():
+            return None
+        # Touch the entry so eviction sees it as recently used
+        os.utime(fpath)
+        return np.load(fpath, mmap_mode="r")
+
+    def put(self, key: str, audio: np.ndarray):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        fpath = self.cache_dir / f"{key}.npy"
+        tmp_fpath = self.cache_dir / f"{key}.{os.getpid()}.tmp"
+        with open(tmp_fpath, "wb") as file:
+            np.save(file, np.asarray(audio, dtype=np.float32))
+        os.replace(tmp_fpath, fpath)
+
+        self.evict()
+        return np.load(fpath, mmap_mode="r")
+
+    def evict(self):
+        entries = []
+        for fpath in self.cache_dir.glob("*.npy"):
+            try:
+                stat = fpath.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fpath))
+        entries.sort()
+
+        total = sum(x[1] for x in entries)
+        # Always keep the most recent entry, even if it is over the limit
+        for _, size, fpath in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            fpath.unlink(missing_ok=True)
+            total -= size
+
+
+class MediaCache:
+    # File bytes keyed by path and mtime, shared between threads
+
+    def __init__(self, max_mb: float = 512, workers: int = 2):
+        self.max_bytes = int(max_mb * 2**20)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(workers)
+
+    def key(self, fpath):
+        return str(fpath), os.stat(fpath).st_mtime_ns
+
+    def get(self, fpath) -> bytes:
+        key = self.key(fpath)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            future = self.pending.get(key)
+
+        if future is not None:
+            try:
+                return future.result()
+            except OSError:
+                pass
+        return self.load(key)
+
+    def load(self, key) -> bytes:
+        try:
+            with open(key[0], "rb") as file:
+                data = file.read()
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = data
+                self.size += len(data)
+            self.entries.move_to_end(key)
+
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+        return data
+
+    def prefetch(self, fpaths):
+        for fpath in fpaths:
+            try:
+                key = self.key(fpath)
+            except FileNotFoundError:
+                continue
+            with self.lock:
+                if key in self.entries or key in self.pending:
+                    continue
+                self.pending[key] = self.pool.submit(self.load, key)
+
+
+def ref_fpaths(ftemplate, session, device, pids, dataset="dev"):
+    if isinstance(pids, str):
+        pids = [pids]
+    return [
+        ftemplate.format(dataset=dataset, session=session, device=device, pid=pid)
+        for pid in pids
+    ]
+
 
 def load_refaudio(
-    ftemplate, session, device, pids, dataset="dev", target_sr=16000, normalize=None
+    ftemplate,
+    session,
+    device,
+    pids,
+    dataset="dev",
+    target_sr=16000,
+    normalize=None,
+    cache=None,
 ) -> Tuple[np.ndarray, int]:
+    fpaths = ref_fpaths(ftemplate, session, device, pids, dataset)
     if isinstance(pids, str):
-        fpath = ftemplate.format(
-            dataset=dataset, session=session, device=device, pid=pids
-        )
-        return load_audio(fpath, target_sr, normalize)
+        return load_audio(fpaths[0], target_sr, normalize, cache=cache)
 
-    for i, pid in enumerate(pids):
-        fpath = ftemplate.format(
-            dataset=dataset, session=session, device=device, pid=pid
-        )
+    if cache is not None:
+        key = cache.key(fpaths, target_sr, None, normalize)
+        audio = cache.get(key)
+        if audio is None:
+            audio = cache.put(key, mix_audio(fpaths, target_sr, normalize))
+        return audio, target_sr
 
-        audio, fs = load_audio(fpath, target_sr, normalize)
+    return mix_audio(fpaths, target_sr, normalize), target_sr
+
+
+def stream_refaudio(
+    ftemplate,
+    session,
+    device,
+    pids,
+    dataset="dev",
+    target_sr=16000,
+    normalize=None,
+    blocksize=BLOCKSIZE,
+):
+    fpaths = ref_fpaths(ftemplate, session, device, pids, dataset)
+    yield from stream_mix(fpaths, target_sr, normalize, blocksize)
+
+
+def write_refaudio(
+    out_fpath,
+    ftemplate,
+    session,
+    device,
+    pids,
+    dataset="dev",
+    target_sr=16000,
+    normalize=None,
+    blocksize=BLOCKSIZE,
+):
+    fpaths = ref_fpaths(ftemplate, session, device, pids, dataset)
+    write_mix(out_fpath, fpaths, target_sr, normalize, blocksize)
 
-        if i == 0:
-            output = audio
-        else:
-            output += audio
 
-    return output, fs
+def stream_audio(fpath, target_sr, blocksize=BLOCKSIZE):
+    with sf.SoundFile(fpath) as file:
+        resampler = None
+        if file.samplerate != target_sr:
+            resampler = soxr.ResampleStream(
+                file.samplerate, target_sr, file.channels, dtype="float64"
+            )
 
+        native_blocksize = max(blocksize * file.samplerate // target_sr, 1)
+        for block in file.blocks(native_blocksize, always_2d=True):
+            if resampler is not None:
+                block = resampler.resample_chunk(block)
+            yield block if file.channels > 1 else block[:, 0]
+
+        if resampler is not None:
+            block = resampler.resample_chunk(np.zeros((0, file.channels)), last=True)
+            yield block if file.channels > 1 else block[:, 0]
+
+
+def stream_rms(fpath, target_sr, blocksize=BLOCKSIZE) -> float:
+    total, count = 0.0, 0
+    for block in stream_audio(fpath, target_sr, blocksize):
+        total += np.sum(np.square(block))
+        count += block.size
+    return np.sqrt(total / max(count, 1))
+
+
+def stream_mix(fpaths, target_sr, normalize=None, blocksize=BLOCKSIZE):
+    # Shorter files count as zero padding; normalize scales each track first
+    gains = [1.0] * len(fpaths)
+
+    with ThreadPoolExecutor(len(fpaths)) as pool:
+        if normalize:
+            rms = pool.map(lambda f: stream_rms(f, target_sr, blocksize), fpaths)
+            gains = [normalize / (x + 1e-5) for x in rms]
+
+        streams = [stream_audio(f, target_sr, blocksize) for f in fpaths]
+        buffers = [None] * len(fpaths)
+        finished = [False] * len(fpaths)
+
+        while not all(finished):
+            active = [i for i, done in enumerate(finished) if not done]
+            blocks = pool.map(lambda i: next(streams[i], None), active)
+            for i, block in zip(active, blocks):
+                if block is None:
+                    finished[i] = True
+                elif buffers[i] is None:
+                    buffers[i] = block * gains[i]
+                else:
+                    buffers[i] = np.concatenate([buffers[i], block * gains[i]])
+
+            # Finished files are zero padding, so only unfinished ones limit output
+            lengths = [len(b) if b is not None else 0 for b in buffers]
+            pending = [n for n, done in zip(lengths, finished) if not done]
+            n_out = min(pending) if len(pending) > 0 else max(lengths)
+            if n_out == 0:
+                continue
+
+            shape = next(b.shape[1:] for b in buffers if b is not None)
+            output = np.zeros((n_out,) + shape)
+            for i, buffer in enumerate(buffers):
+                if buffer is None:
+                    continue
+                output[: len(buffer[:n_out])] += buffer[:n_out]
+                buffers[i] = buffer[n_out:]
+            yield output
+
+
+def mix_audio(fpaths, target_sr, normalize=None, blocksize=BLOCKSIZE) -> np.ndarray:
+    infos = [sf.info(f) for f in fpaths]
+    length = max(-(-x.frames * target_sr // x.samplerate) for x in infos)
+
+    # Fill a single preallocated float32 buffer rather than summing whole tracks
+    output = None
+    filled = 0
+    for block in stream_mix(fpaths, target_sr, normalize, blocksize):
+        if output is None:
+            output = np.zeros((length,) + block.shape[1:], dtype=np.float32)
+        if filled + len(block) > len(output):
+            output = np.concatenate([output, np.zeros_like(block, np.float32)])
+        output[filled : filled + len(block)] = block
+        filled += len(block)
+
+    return output[:filled]
+
+
+def write_mix(out_fpath, fpaths, target_sr, normalize=None, blocksize=BLOCKSIZE):
+    Path(out_fpath).parent.mkdir(parents=True, exist_ok=True)
+
+    file = None
+    try:
+        for block in stream_mix(fpaths, target_sr, normalize, blocksize):
+            if file is None:
+                channels = 1 if block.ndim == 1 else block.shape[1]
+                file = sf.SoundFile(out_fpath, "w", target_sr, channels)
+            file.write(block)
+    finally:
+        if file is not None:
+            file.close()
+
+
+def load_audio(
+    fpath, target_sr, normalize=None, channels=None, cache=None
+) -> Tuple[np.ndarray, int]:
+    if cache is not None:
+        key = cache.key(fpath, target_sr, channels, normalize)
+        audio = cache.get(key)
+        if audio is None:
+            audio, _ = load_audio(fpath, target_sr, normalize, channels)
+            audio = cache.put(key, audio)
+        return audio, target_sr
 
-def load_audio(fpath, target_sr, normalize=None) -> Tuple[np.ndarray, int]:
     audio, fs = sf.read(fpath)
 
+    if channels is not None and audio.ndim == 2:
+        audio = audio[:, channels]
+
     if fs != target_sr:
         audio = soxr.resample(audio, fs, target_sr)
 
@@ -43,12 +322,165 @@ def load_audio(fpath, target_sr, normalize=None) -> Tuple[np.ndarray, int]:
     return audio, target_sr
 
 
+def native_window(start, end, fs, target_sr, n_frames, margin=0.1):
+    # Native read window, aligned so resampling lands on the target grid
+    step = fs // math.gcd(fs, target_sr)
+    pad = int(margin * fs)
+    native_start = max(start * fs // target_sr - pad, 0) // step * step
+    native_end = min(-(-end * fs // target_sr) + pad, n_frames)
+    return native_start, max(native_end, native_start), native_start * target_sr // fs
+
+
+def read_window(file: sf.SoundFile, start, end, target_sr, margin=0.1) -> np.ndarray:
+    fs = file.samplerate
+    start = max(start, 0)
+
+    if fs == target_sr:
+        file.seek(min(start, file.frames))
+        return file.read(max(end - start, 0))
+
+    native_start, native_end, offset = native_window(
+        start, end, fs, target_sr, file.frames, margin
+    )
+    file.seek(native_start)
+    audio = file.read(native_end - native_start)
+    audio = soxr.resample(audio, fs, target_sr)
+
+    return audio[start - offset : end - offset]
+
+
+class SessionAudio:
+    # Memory-mapped WAV; slices are counted at target_sr
+
+    def __init__(self, fpath, channels=None, target_sr=None):
+        self.fpath = str(fpath)
+        self.channels = channels
+
+        fmt, data_offset, data_size = self._parse_header()
+        audio_format, n_channels, samplerate, _, block_align, bits = fmt
+
+        self.samplerate = samplerate
+        self.target_sr = target_sr or samplerate
+        self.n_channels = n_channels
+        self.frames = data_size // block_align
+
+        width = self._width = bits // 8
+        if audio_format == WAVE_FORMAT_IEEE_FLOAT and width in [4, 8]:
+            dtype, self._scale = f"<f{width}", 1.0
+        elif audio_format == WAVE_FORMAT_PCM and width == 1:
+            dtype, self._scale = "u1", 2.0**7
+        elif audio_format == WAVE_FORMAT_PCM and width in [2, 4]:
+            dtype, self._scale = f"<i{width}", 2.0 ** (bits - 1)
+        elif audio_format == WAVE_FORMAT_PCM and width == 3:
+            dtype, self._scale = "u1", 2.0**23
+        else:
+            raise ValueError(f"Unsupported WAV format {audio_format}/{bits} bit")
+
+        shape = (
+            (self.frames, n_channels, 3) if width == 3 else (self.frames, n_channels)
+        )
+        self._data = np.memmap(
+            self.fpath, dtype=dtype, mode="r", offset=data_offset, shape=shape
+        )
+
+    def _parse_header(self):
+        fmt = None
+        with open(self.fpath, "rb") as file:
+            riff, _, wave = struct.unpack("<4sI4s", file.read(12))
+            if riff != b"RIFF" or wave != b"WAVE":
+                raise ValueError(f"{self.fpath} is not a RIFF/WAVE file")
+
+            while True:
+                header = file.read(8)
+                if len(header) < 8:
+                    raise ValueError(f"{self.fpath} has no data chunk")
+                chunk_id, size = struct.unpack("<4sI", header)
+
+                if chunk_id == b"fmt ":
+                    chunk = file.read(size + size % 2)
+                    fmt = list(struct.unpack("<HHIIHH", chunk[:16]))
+                    if fmt[0] == WAVE_FORMAT_EXTENSIBLE:
+                        # Sub-format GUID starts with the actual format code
+                        fmt[0] = struct.unpack("<H", chunk[24:26])[0]
+                elif chunk_id == b"data":
+                    if fmt is None:
+                        raise ValueError(f"{self.fpath} has data before fmt")
+                    return fmt, file.tell(), size
+                else:
+                    file.seek(size + size % 2, os.SEEK_CUR)
+
+    def __len__(self):
+        return -(-self.frames * self.target_sr // self.samplerate)
+
+    def _read_native(self, start, end) -> np.ndarray:
+        channels = self.channels
+        if channels is None or self.n_channels == 1:
+            channels = slice(None)
+
+        raw = self._data[start:end, channels]
+        if self._width == 3:
+            # Assemble little-endian 24 bit samples and sign extend
+            raw = raw.astype(np.int32)
+            raw = (raw[..., 0] << 8 | raw[..., 1] << 16 | raw[..., 2] << 24) >> 8
+        elif self._width == 1:
+            raw = raw.astype(np.int16) - 128
+
+        audio = raw.astype(np.float32) / np.float32(self._scale)
+        if self.n_channels == 1:
+            audio = audio[:, 0]
+        return audio
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, slice) or key.step not in [None, 1]:
+            raise TypeError("SessionAudio only supports contiguous slices")
+        start, end, _ = key.indices(len(self))
+
+        if self.samplerate == self.target_sr:
+            return self._read_native(start, max(end, start))
+
+        native_start, native_end, offset = native_window(
+            start, end, self.samplerate, self.target_sr, self.frames
+        )
+        audio = self._read_native(native_start, native_end)
+        audio = soxr.resample(audio, self.samplerate, self.target_sr)
+        return audio[start - offset : end - offset]
+
+
+class SoundFileAudio:
+    # Same slicing as SessionAudio, decoding each window through soundfile
+
+    def __init__(self, fpath, channels=None, target_sr=None):
+        self.file = sf.SoundFile(fpath)
+        self.channels = channels
+        self.samplerate = self.file.samplerate
+        self.target_sr = target_sr or self.samplerate
+
+    def __len__(self):
+        return -(-self.file.frames * self.target_sr // self.samplerate)
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, slice) or key.step not in [None, 1]:
+            raise TypeError("SoundFileAudio only supports contiguous slices")
+        start, end, _ = key.indices(len(self))
+
+        audio = read_window(self.file, start, end, self.target_sr)
+        if audio.ndim == 2 and self.channels is not None:
+            audio = audio[:, self.channels]
+        return audio.astype(np.float32)
+
+
+def open_session(fpath, channels=None, target_sr=None):
+    try:
+        return SessionAudio(fpath, channels, target_sr)
+    except (ValueError, struct.error):
+        # RF64, W64, FLAC and other files that cannot be mapped directly
+        return SoundFileAudio(fpath, channels, target_sr)
+
+
 def rms_norm(audio, target_rms):
     audio_rms = np.sqrt(np.mean(np.square(audio))) + 1e-5
 
-    audio *= target_rms / audio_rms
-
-    return audio
+    return audio * (target_rms / audio_rms)
 
 
 def load_csv(fpath: str | Path):
@@ -66,8 +498,182 @@ def load_json(fpath: str | Path):
 def save_json(fpath: str | Path, data):
     parent = Path(fpath).parent
     parent.mkdir(exist_ok=True, parents=True)
-    with open(fpath, "w") as file:
+    # Write then rename, so an interrupted save never leaves a truncated file
+    tmp_fpath = parent / f".{Path(fpath).name}.{os.getpid()}.tmp"
+    with open(tmp_fpath, "w") as file:
         json.dump(data, file, indent=4)
+    os.replace(tmp_fpath, fpath)
+
+
+def load_jsonl(fpath: str | Path):
+    if not Path(fpath).exists():
+        return []
+    records = []
+    with open(fpath) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Last line of a journal whose writer was killed mid-record
+                continue
+    return records
+
+
+def append_jsonl(file, record):
+    file.write(json.dumps(record) + "\n")
+    file.flush()
+    os.fsync(file.fileno())
+
+
+def file_hash(fpath: str | Path, chunk_size=2**20):
+    digest = hashlib.sha1()
+    with open(fpath, "rb") as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RepresentationStore:
+    # Arrays in data.bin indexed by index.json, with the source each came from
+
+    ALIGN = 64
+
+    def __init__(self, store_dir: str | Path):
+        self.store_dir = Path(store_dir)
+        self.data_fpath = self.store_dir / "data.bin"
+        self.index_fpath = self.store_dir / "index.json"
+        self._mmap = None
+        self._recover()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def stamp(self, key):
+        return self.index[key]["stamp"] if key in self.index else None
+
+    def append(self, key, array, stamp=None, source=None):
+        previous = self.index.get(key, {}).get("source")
+        if previous is not None and source is not None and previous != source:
+            print(f"Replacing {key} from {previous} with {source}")
+
+        array = np.ascontiguousarray(array)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+
+        with open(self.data_fpath, "ab") as file:
+            offset = file.tell()
+            # Pad so every entry can be viewed in place with its own dtype
+            padding = -offset % self.ALIGN
+            file.write(b"\0" * padding)
+            file.write(array.tobytes())
+
+        self.index[key] = {
+            "offset": offset + padding,
+            "shape": list(array.shape),
+            "dtype": array.dtype.str,
+            "stamp": stamp,
+            "source": source,
+        }
+        self._mmap = None
+
+    def flush(self):
+        save_json(self.index_fpath, self.index)
+
+    def __getitem__(self, key) -> np.ndarray:
+        entry = self.index[key]
+        if self._mmap is None:
+            # Copy-on-write, so views are writable without touching the file
+            self._mmap = np.memmap(self.data_fpath, dtype=np.uint8, mode="c")
+
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"]))
+        start = entry["offset"]
+        data = self._mmap[start : start + count * dtype.itemsize]
+        return data.view(dtype).reshape(entry["shape"])
+
+    def size(self) -> int:
+        return self.data_fpath.stat().st_size if self.data_fpath.exists() else 0
+
+    def garbage(self) -> int:
+        # Bytes of superseded entries, counting each live entry with its padding
+        used = sum(
+            -(-self._nbytes(x) // self.ALIGN) * self.ALIGN for x in self.index.values()
+        )
+        return max(self.size() - used, 0)
+
+    def compact(self):
+        # Write live entries to .new files, then replace data before index;
+        # _recover() finishes or discards a replace that was interrupted
+        new_data, new_index = self._new_fpaths()
+        index = {}
+        with open(new_data, "wb") as file:
+            for key, entry in self.index.items():
+                file.write(b"\0" * (-file.tell() % self.ALIGN))
+                index[key] = {**entry, "offset": file.tell()}
+                file.write(self[key].tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+        save_json(new_index, index)
+
+        self._mmap = None
+        os.replace(new_data, self.data_fpath)
+        os.replace(new_index, self.index_fpath)
+        self.index = index
+
+    def _new_fpaths(self):
+        return (
+            self.data_fpath.with_suffix(".bin.new"),
+            self.index_fpath.with_suffix(".json.new"),
+        )
+
+    def _nbytes(self, entry):
+        return int(np.prod(entry["shape"])) * np.dtype(entry["dtype"]).itemsize
+
+    def _recover(self):
+        # Until data.bin is replaced the old pair is intact; after that only
+        # the new index is left to move into place
+        new_data, new_index = self._new_fpaths()
+        if new_data.exists():
+            new_data.unlink()
+            new_index.unlink(missing_ok=True)
+        elif new_index.exists():
+            os.replace(new_index, self.index_fpath)
+        self.index = load_json(self.index_fpath) if self.index_fpath.exists() else {}
+
+        # Stores compacted by moving data.bin aside: keep the rebuilt file
+        # only if the index was saved for it, which packs entries in order
+        old_data = self.data_fpath.with_suffix(".bin.old")
+        if old_data.exists():
+            end = 0
+            for entry in self.index.values():
+                end += -end % self.ALIGN
+                if entry["offset"] != end:
+                    break
+                end += self._nbytes(entry)
+            else:
+                if self.size() >= end:
+                    old_data.unlink()
+                    return
+            os.replace(old_data, self.data_fpath)
+
+
+def segment_systems(seg):
+    # Every field holding a segment's audio, other than the reference itself
+    return [
+        key
+        for key, value in seg.items()
+        if key != "ref" and isinstance(value, str) and value.endswith(".wav")
+    ]
+
+
+def lookup(registry: dict, name: str, kind: str):
+    if name not in registry:
+        raise ValueError(f"{kind} {name} not recognised, choose from {list(registry)}")
+    return registry[name]
 
 
 def get_wearer_targets(session_info):